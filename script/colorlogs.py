@@ -5,9 +5,14 @@
 Perform syntax highlighting on Scribe logs.
 """
 
-import sys, os, re
+import sys, os, re, stat
+import mmap
 import time
 import errno
+import functools
+import collections
+import contextlib
+import concurrent.futures
 
 import instabot
 
@@ -17,114 +22,175 @@ COLORS = {None: '\033[0m', 'bold': '\033[1m', 'black': '\033[30m',
     'blue': '\033[34m', 'magenta': '\033[35m', 'cyan': '\033[36m',
     'gray': '\033[37m'}
 
-def highlight(line, filt=None):
-    def highlight_scalar(val):
-        if val in instabot.CONSTANTS:
-            return (COLORS['magenta'], val)
-        elif instabot.INTEGER.match(val) or instabot.FLOAT.match(val):
-            return (COLORS['cyan'], val)
-        else:
-            return (COLORS[None], val)
-    def highlight_tuple(val):
-        if val[:1] != '(': return (COLORS['red'], val)
-        idx, ret = 1, [COLORS['orange'], '(']
-        m = instabot.WHITESPACE.match(val, idx)
-        if m:
-            ret.append(m.group())
-            idx = m.end()
-        while idx < len(val):
-            m = instabot.SCALAR.match(val, idx)
-            if not m: break
-            ret.extend(highlight_scalar(m.group()))
-            idx = m.end()
-            m = instabot.COMMA.match(val, idx)
-            if not m: break
-            ret.extend((COLORS['orange'], m.group()))
-            idx = m.end()
-        m = instabot.WHITESPACE.match(val, idx)
-        if m:
-            ret.extend((COLORS['orange'], m.group()))
-            idx = m.end()
-        if val[idx:] == ')':
-            ret.extend((COLORS['orange'], ')'))
-        else:
-            # Should not happen...
-            ret.extend((COLORS['red'], val[idx:]))
-        return ret
-    def highlight_scalar_or_tuple(val):
-        if val.startswith('('):
-            return highlight_tuple(val)
-        else:
-            return highlight_scalar(val)
-    def highlight_dict(val):
-        if val[:1] != '{': return (COLORS['red'], val)
-        idx, ret = 1, [COLORS['orange'], '{']
-        m = instabot.WHITESPACE.match(val, idx)
-        if m:
-            ret.append(m.group())
-            idx = m.end()
-        while idx < len(val):
-            m = instabot.DICT_ENTRY.match(val, idx)
-            if not m: break
-            ret.extend(highlight_scalar_or_tuple(m.group(1)))
-            ret.extend((COLORS['orange'], val[m.end(1):m.start(2)]))
-            ret.extend(highlight_scalar_or_tuple(m.group(2)))
-            idx = m.end()
-            m = instabot.COMMA.match(val, idx)
-            if not m: break
-            ret.extend((COLORS['orange'], m.group()))
-            idx = m.end()
-        m = instabot.WHITESPACE.match(val, idx)
-        if m:
-            ret.extend((COLORS['orange'], m.group()))
-            idx = m.end()
-        if val[idx:] == '}':
-            ret.extend((COLORS['orange'], '}'))
-        else:
-            # Should not happen...
-            ret.extend((COLORS['red'], val[idx:]))
-        return ret
-    def highlight_any(val):
-        if val.startswith('{'):
-            return highlight_dict(val)
-        elif val.startswith('('):
-            return highlight_tuple(val)
-        else:
-            return highlight_scalar(val)
-    m = instabot.LOGLINE.match(line)
+# The same, pre-encoded for use on the byte strings highlight() operates on,
+# and indexed by the constants below.
+RESET, BOLD, BLACK, RED, GREEN, ORANGE, BLUE, MAGENTA, CYAN, GRAY = range(10)
+COLOR_CODES = tuple(COLORS[k].encode('ascii') for k in (None, 'bold',
+    'black', 'red', 'green', 'orange', 'blue', 'magenta', 'cyan', 'gray'))
+
+# Buffer size for input and (unless line-buffered) output files.
+BUFFER_SIZE = 1048576
+# Approximate size of the input pieces handed to worker processes.
+PARALLEL_CHUNK_SIZE = 4194304
+
+# Byte-string versions of instabot's regular expressions (which are all
+# ASCII-only) and constant names.
+LOGLINE = re.compile(instabot.LOGLINE.pattern.encode('ascii'))
+FLOAT = re.compile(instabot.FLOAT.pattern.encode('ascii'))
+CONSTANTS = frozenset(k.encode('ascii') for k in instabot.CONSTANTS)
+
+# Tokenizers for the key-value section of a log line and for the contents of
+# a (previously validated) tuple or dict value, respectively. Whitespace
+# directly after an opening bracket is lumped together with it; strings are
+# tried before bare words so that Py2K-style u"..." literals stay in one piece.
+PARAM_TOKEN = re.compile((r'(?P<ws>\s+)|(?P<name>[a-zA-Z0-9_-]+)='
+    r'(?P<value>%s|%s|%s)(?=\s|$)' % (instabot.SCALAR.pattern,
+    instabot.TUPLE.pattern, instabot.DICT.pattern)).encode('ascii'))
+VALUE_TOKEN = re.compile(br'(?P<scalar>u?"(?:[^"\\]|\\.)*"|'
+    br'u?\'(?:[^\'\\]|\\.)*\'|[^"\'()[\]{},:\s]+)|'
+    br'(?P<punct>[({]\s*|\s*[,:]\s*|\s+|[)}])')
+
+# Log lines tend to repeat a small set of values (constants, small numbers,
+# enumeration-like bare words), so this is memoized.
+@functools.lru_cache(maxsize=4096)
+def highlight_scalar(val):
+    # Equivalent to matching instabot.INTEGER, but without involving the
+    # regular expression engine.
+    digits = val[1:] if val[:1] in (b'+', b'-') else val
+    if val in CONSTANTS:
+        return COLOR_CODES[MAGENTA] + val
+    elif digits.isdigit() or FLOAT.match(val):
+        return COLOR_CODES[CYAN] + val
+    else:
+        return COLOR_CODES[RESET] + val
+
+# Tuples and dicts recur as well (e.g. as addresses), and, in contrast to
+# scalars, need to be tokenized, so caching them pays off even more. val must
+# have been validated (e.g. by PARAM_TOKEN) beforehand.
+@functools.lru_cache(maxsize=4096)
+def highlight_compound(val):
+    orange = COLOR_CODES[ORANGE]
+    return b''.join(highlight_scalar(scalar) if scalar else orange + punct
+                    for scalar, punct in VALUE_TOKEN.findall(val))
+
+def highlight(line, filt=None, end=None):
+    # Only line[:end] is highlighted; the rest (e.g. a trailing newline) is
+    # appended verbatim.
+    if end is None: end = len(line)
+    m = LOGLINE.match(line, 0, end)
     if not m: return line
-    if filt and not filt(m.group(2)): return None
-    ret = [line[:m.start(2)], COLORS['bold'], m.group(2), COLORS[None],
-           line[m.end(2):m.start(3)]]
+    tag = m[2]
+    if filt and not filt(tag): return None
+    tag_start, tag_end = m.span(2)
     idx = m.start(3)
-    if idx != -1:
-        while idx < len(line):
-            # Skip whitespace
-            m = instabot.WHITESPACE.match(line, idx)
-            if m:
-                ret.extend((COLORS[None], m.group()))
-                idx = m.end()
-                if idx == len(line): break
-            # Match the next parameter; output name
-            m = instabot.PARAM.match(line, idx)
-            if not m: break
-            name, val = m.group(1, 2)
-            ret.extend((COLORS['green'], name, '='))
-            # Output value
-            ret.extend(highlight_any(val))
-            idx = m.end()
-        ret.extend((COLORS[None], line[idx:]))
-    return ''.join(ret)
+    if idx == -1:
+        # No key-value section at all.
+        return b''.join((line[:tag_start], COLOR_CODES[BOLD], tag,
+                         COLOR_CODES[RESET], line[tag_end:]))
+    # Bind the regexes and colors used below to local names to spare the
+    # interpreter repeated global and color table lookups.
+    iter_params = PARAM_TOKEN.finditer
+    hl_scalar, hl_compound = highlight_scalar, highlight_compound
+    reset, bold, green = (COLOR_CODES[RESET], COLOR_CODES[BOLD],
+                          COLOR_CODES[GREEN])
+    ret = [line[:tag_start], bold, tag, reset, line[tag_end:idx]]
+    for m in iter_params(line, idx, end):
+        # Stop at the first thing that is neither whitespace nor a
+        # well-formed parameter; it is output verbatim below.
+        if m.start() != idx: break
+        idx = m.end()
+        if m.lastgroup == 'ws':
+            ret.extend((reset, m[0]))
+            continue
+        ret.extend((green, m['name'], b'='))
+        val = m['value']
+        if val[0] not in b'({':
+            ret.append(hl_scalar(val))
+        else:
+            ret.append(hl_compound(val))
+    ret.extend((reset, line[idx:end], line[end:]))
+    return b''.join(ret)
+
+def _highlight_stream_plain(it, filt):
+    for line in it:
+        # LOGLINE is anchored at an opening bracket, so any other line can be
+        # passed through without consulting highlight() at all.
+        if line[:1] != b'[':
+            yield line
+            continue
+        hl = highlight(line, filt)
+        if hl is not None: yield hl
+
+def _highlight_stream_newlines(it, filt):
+    for line in it:
+        # Only the last line of a file may lack a newline. Afterwards, line
+        # is not empty, so we can compare its first byte as an integer.
+        if line[-1:] != b'\n': line += b'\n'
+        if line[0] != 0x5B: # '['
+            yield line
+            continue
+        hl = highlight(line, filt, len(line) - 1)
+        if hl is not None: yield hl
 
 def highlight_stream(it, newlines=False, filt=None):
-    if not newlines:
-        for line in it:
-            hl = highlight(line, filt)
-            if hl is not None: yield hl
+    if newlines:
+        return _highlight_stream_newlines(it, filt)
     else:
-        for line in it:
-            hl = highlight(line.rstrip('\n'), filt)
-            if hl is not None: yield hl + '\n'
+        return _highlight_stream_plain(it, filt)
+
+def _mmap_lines(fp, start=0, end=None):
+    # Iterate over the lines of the regular file fp that start between the
+    # given offsets without copying the whole range into a buffer first.
+    size = os.fstat(fp.fileno()).st_size
+    if end is None or end > size: end = size
+    if start >= end: return
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(start)
+        readline, tell = mm.readline, mm.tell
+        while tell() < end:
+            yield readline()
+
+def _make_filter(ignore):
+    return (lambda t: t not in ignore) if ignore else None
+
+def _split_file(fp, chunksize):
+    offsets = [0]
+    size = os.fstat(fp.fileno()).st_size
+    while offsets[-1] < size:
+        # Extend every chunk to the end of the line it would otherwise cut.
+        fp.seek(offsets[-1] + chunksize)
+        fp.readline()
+        offsets.append(min(fp.tell(), size))
+    return list(zip(offsets, offsets[1:]))
+
+def _highlight_range(args):
+    path, start, end, ignore = args
+    with open(path, 'rb') as fp:
+        return b''.join(highlight_stream(_mmap_lines(fp, start, end), True,
+                                         _make_filter(ignore)))
+
+def highlight_file_parallel(path, jobs, ignore=()):
+    """
+    Highlight the regular file at path using jobs worker processes.
+
+    Returns an iterator of highlighted byte strings, each covering some
+    complete lines of the file, in file order. ignore is a collection of
+    tags whose lines are to be omitted. Only about twice as many pieces as
+    there are workers are processed ahead of the consumer, so that a slow
+    output does not cause the whole highlighted file to pile up in memory.
+    """
+    with open(path, 'rb') as fp:
+        ranges = _split_file(fp, PARALLEL_CHUNK_SIZE)
+    window = 2 * jobs
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        pending = collections.deque()
+        for start, end in ranges:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_highlight_range,
+                                           (path, start, end, ignore)))
+        while pending:
+            yield pending.popleft().result()
 
 def main():
     p = instabot.OptionParser(sys.argv[0])
@@ -138,19 +204,42 @@ def main():
               help='Append to output file instead of overwriting it')
     p.flag('line-buffered', short='u',
            help='Flush output after each input line')
+    p.option('jobs', short='j', default=1, type=int,
+             help='Use this many processes (only if the input is a regular '
+                 'file and --line-buffered is not given)')
     p.argument('in', default='-',
                help='File to read from (- is standard input and '
                    'the default)')
     p.parse(sys.argv[1:])
     ignore, inpath, outpath = p.get('exclude', 'in', 'out')
-    outmode, linebuf = p.get('outmode', 'line-buffered')
+    outmode, linebuf, jobs = p.get('outmode', 'line-buffered', 'jobs')
     try:
-        filt = (lambda t: t not in ignore) if ignore else None
+        ignore = frozenset(t.encode('utf-8') for t in ignore)
+        # Worker processes produce output in multi-line pieces, which would
+        # defeat line buffering.
+        parallel = (jobs > 1 and not linebuf and
+                    inpath not in (None, '-') and
+                    stat.S_ISREG(os.stat(inpath).st_mode))
         of = instabot.open_file
-        with of(inpath, 'r') as fi, of(outpath, outmode) as fo:
-            for l in highlight_stream(fi, True, filt):
-                fo.write(l)
-                if linebuf: fo.flush()
+        with contextlib.ExitStack() as stack:
+            # The workers open the input themselves.
+            if not parallel:
+                fi = stack.enter_context(of(inpath, 'rb',
+                                            buffering=BUFFER_SIZE))
+            fo = stack.enter_context(of(outpath, outmode + 'b',
+                                        buffering=BUFFER_SIZE))
+            if parallel:
+                lines = highlight_file_parallel(inpath, jobs, ignore)
+            else:
+                lines = highlight_stream(fi, True, _make_filter(ignore))
+            # An explicit buffer size disables the automatic line buffering
+            # of terminals, so we emulate it.
+            if linebuf or fo.isatty():
+                for l in lines:
+                    fo.write(l)
+                    fo.flush()
+            else:
+                fo.writelines(lines)
     except KeyboardInterrupt:
         # Suppress noisy stack traces.
         pass
@@ -86,10 +86,11 @@ generator); the Exit suspend provides that functionality instead.
 """
 
 import sys, os, time
-import heapq
+import heapq, operator
+import functools
 import traceback
 import errno, signal, socket, select
-import subprocess
+import shutil, subprocess
 
 try:
     import fcntl
@@ -98,6 +99,15 @@ except ImportError:
 
 SIGPIPE_CHUNK_SIZE = 1024
 LINEREADER_CHUNK_SIZE = 16384
+LINEREADER_MAX_CHUNK_SIZE = 262144
+SLEEP_BUCKETS_PER_SECOND = 1000.0
+
+# Placeholder for the results of All's nested suspends that did not finish.
+_UNFINISHED = object()
+
+# Absolute paths of programs spawned by SpawnProcess, indexed by (name, search
+# path) pairs.
+_EXEC_CACHE = {}
 
 class Tag(object):
     """
@@ -110,28 +120,37 @@ class Tag(object):
     differentiate file descriptors from process ID-s.
 
     The value passed to the constructor is available as the "value" instance
-    attribute.
+    attribute; since the hash code is computed upon construction, it must not
+    be changed afterwards.
     """
 
+    __slots__ = ('value', '_hash')
+
     def __init__(self, value):
         "Initializer; see class docstring for details"
         self.value = value
+        self._hash = hash((self.__class__, value))
 
     def __hash__(self):
         "Compute a hash code of this instance"
-        return hash((self.__class__, self.value))
+        return self._hash
 
     def __eq__(self, other):
         "Test whether this instance is equal to other"
-        return other.__class__ == self.__class__ and other.value == self.value
+        if other is self: return True
+        return other.__class__ is self.__class__ and other.value == self.value
 
     def __ne__(self, other):
         "Test whether this instance is not equal to other"
-        return other.__class__ != self.__class__ or other.value != self.value
+        if other is self: return False
+        return (other.__class__ is not self.__class__ or
+                other.value != self.value)
 
 class ProcessTag(Tag):
     "A Tag subclass for labeling process ID-s"
 
+    __slots__ = ()
+
 class Suspend(object):
     """
     A Suspend encapsulates a temporary interruption of a coroutine's execution
@@ -153,10 +172,12 @@ class Suspend(object):
     The Suspend class is abstract; subclasses should override the apply()
     method to specialize what they actually do. Suspend objects must be
     hashable and usable as dictionary keys; while they may override comparison
-    operators (like Sleep does), different Suspend objects (w.r.t. the
-    identity comparison "is") must always be unequal.
+    operators, different Suspend objects (w.r.t. the identity comparison "is")
+    must always be unequal.
     """
 
+    __slots__ = ()
+
     def apply(self, wake, executor, routine):
         """
         Initiate the action corresponding to this suspend
@@ -217,6 +238,8 @@ class CombinationSuspend(Suspend):
     apply() is kept abstract.
     """
 
+    __slots__ = ('children',)
+
     def __init__(self, children):
         "Initializer; see class docstring for details"
         self.children = children
@@ -243,20 +266,22 @@ class All(CombinationSuspend):
     children.
     """
 
+    __slots__ = ('result', '_finished_count', '_raised', '_callback')
+
     # All is the suspend incarnation of product types -- the result is a tuple
     # (implemented as a Python list) of the results of the nested suspends.
 
     def __init__(self, *suspends):
         "Initializer; see class docstring for details"
         CombinationSuspend.__init__(self, suspends)
-        self.result = [None] * len(suspends)
-        self._finished = [False] * len(suspends)
+        self.result = [_UNFINISHED] * len(suspends)
         self._finished_count = 0
         self._raised = False
+        self._callback = None
 
-    def _finish(self, index, value, callback):
+    def _finish(self, index, value):
         "Internal callback invoked when a nested suspend finishes"
-        if self._finished[index]:
+        if self.result[index] is not _UNFINISHED:
             raise RuntimeError('Attempting to wake a coroutine more than '
                 'once')
         elif self._finished_count == -1:
@@ -266,27 +291,47 @@ class All(CombinationSuspend):
         if value[0] == 1:
             self._finished_count = -1
             self._raised = True
-            callback(value)
+            self._callback(value)
             return
         self.result[index] = value[1]
-        self._finished[index] = True
         self._finished_count += 1
         if self._finished_count == len(self.children):
             self._finished_count = -1
-            callback((0, self.result))
+            self._callback((0, self.result))
+
+    def _finish_one(self, value):
+        "Internal callback invoked when the only nested suspend finishes"
+        if self.result[0] is not _UNFINISHED:
+            raise RuntimeError('Attempting to wake a coroutine more than '
+                'once')
+        elif self._finished_count == -1:
+            return
+        self._finished_count = -1
+        if value is not None and value[0] == 1:
+            self._raised = True
+            self._callback(value)
+            return
+        self.result[0] = None if value is None else value[1]
+        self._callback((0, self.result))
 
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
-        def make_wake(index):
-            return lambda value: self._finish(index, value, wake)
-        for n, s in enumerate(self.children):
+        children = self.children
+        if not children:
+            self._finished_count = -1
+            wake((0, self.result))
+            return
+        self._callback = wake
+        if len(children) == 1:
+            # No sibling can be pending, so there is nothing to cancel.
+            children[0].apply(self._finish_one, executor, routine)
+            return
+        finish = self._finish
+        for n, s in enumerate(children):
             if self._raised: break
-            s.apply(make_wake(n), executor, routine)
+            s.apply(functools.partial(finish, n), executor, routine)
         if self._raised:
             self.cancel()
-        elif len(self.children) == self._finished_count == 0:
-            self._finished_count = -1
-            wake((0, self.result))
 
     def cancel(self):
         "Cancel this suspend"
@@ -305,6 +350,8 @@ class Any(CombinationSuspend):
     are cancelled. Cancelling an Any suspend cancels all of its children.
     """
 
+    __slots__ = ('_do_wake', '_callback')
+
     # Any is the suspend incarnation of coproduct types (tagged unions) -- the
     # result is, as noted, an index (the suspend) together with the
     # corresponding value.
@@ -313,28 +360,29 @@ class Any(CombinationSuspend):
         "Initializer; see class docstring for details"
         CombinationSuspend.__init__(self, suspends)
         self._do_wake = True
+        self._callback = None
 
-    def _wake(self, suspend, value, callback):
+    def _wake(self, suspend, value):
         "Internal callback invoked when a nested suspend finishes"
         if not self._do_wake: return
         self._do_wake = False
         if value is None:
             value = (0, None)
         if value[0] == 1:
-            callback(value)
+            self._callback(value)
         else:
-            callback((0, (suspend, value[1])))
+            self._callback((0, (suspend, value[1])))
         for s in self.children:
             if s is not suspend:
                 s.cancel()
 
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
-        def make_wake(suspend):
-            return lambda value: self._wake(suspend, value, wake)
+        self._callback = wake
+        do_wake = self._wake
         for s in self.children:
             if not self._do_wake: break
-            s.apply(make_wake(s), executor, routine)
+            s.apply(functools.partial(do_wake, s), executor, routine)
 
     def cancel(self):
         "Cancel this suspend"
@@ -366,6 +414,8 @@ class Selector(CombinationSuspend):
     Selector object multiple times.
     """
 
+    __slots__ = ('_pending', '_waiting', '_finished', '_callback', '_wakes')
+
     def __init__(self, *suspends):
         "Initializer; see class docstring for details"
         CombinationSuspend.__init__(self, list(suspends))
@@ -373,6 +423,8 @@ class Selector(CombinationSuspend):
         self._waiting = set()
         self._finished = {}
         self._callback = None
+        self._wakes = dict((s, functools.partial(self._wake, s))
+                           for s in suspends)
 
     def is_empty(self):
         """
@@ -394,6 +446,7 @@ class Selector(CombinationSuspend):
         """
         self.children.append(suspend)
         self._pending.add(suspend)
+        self._wakes[suspend] = functools.partial(self._wake, suspend)
 
     def _wake(self, suspend, value):
         "Internal callback invoked whenever a nested suspend finishes"
@@ -401,12 +454,12 @@ class Selector(CombinationSuspend):
             self._waiting.remove(suspend)
         except KeyError:
             raise RuntimeError('Trying to wake non-suspended coroutine')
-        if self._callback is None:
-            if suspend in self._pending:
-                raise RuntimeError('Trying to wake coroutine more than once')
-            self._pending[suspend] = value
-        else:
+        if self._callback is not None:
             self._report(suspend, value)
+            return
+        if suspend in self._finished:
+            raise RuntimeError('Trying to wake coroutine more than once')
+        self._finished[suspend] = value
 
     def _report(self, suspend, value):
         "Internal; reports a child's result to the Selector's caller"
@@ -418,6 +471,7 @@ class Selector(CombinationSuspend):
             self._callback((0, (suspend, value[1])))
         self._callback = None
         self._finished.pop(suspend, None)
+        self._wakes.pop(suspend, None)
         try:
             self.children.remove(suspend)
         except ValueError:
@@ -425,20 +479,21 @@ class Selector(CombinationSuspend):
 
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
-        def make_wake(suspend):
-            return lambda value: self._wake(suspend, value)
         self._callback = wake
         if self._pending:
             pending = tuple(self._pending)
             self._pending.clear()
             self._waiting.update(pending)
+            wakes = self._wakes
             for p in pending:
-                p.apply(make_wake(p), executor, routine)
-        if self._finished:
-            self._report(*self._finished.popitem())
-        elif self.is_empty() and self._callback:
-            wake((None, None))
-            self._callback = None
+                p.apply(wakes[p], executor, routine)
+        # A child might have finished (and been reported) synchronously.
+        if self._callback is not None:
+            if self._finished:
+                self._report(*self._finished.popitem())
+            elif self.is_empty():
+                self._callback = None
+                wake((0, (None, None)))
 
     def cancel(self):
         """
@@ -450,6 +505,7 @@ class Selector(CombinationSuspend):
         self._pending.clear()
         self._waiting.clear()
         self._finished.clear()
+        self._wakes.clear()
         self._callback = None
         CombinationSuspend.cancel(self)
         self.children[:] = []
@@ -469,26 +525,35 @@ class WrapperSuspend(CombinationSuspend):
     captured and propagated to the caller instead of process' return value.
     """
 
+    __slots__ = ('process', '_callback')
+
     def __init__(self, wrapped, process=None):
         "Initializer; see class docstring for details"
         CombinationSuspend.__init__(self, (wrapped,))
         self.process = process
+        self._callback = None
+
+    def _inner_wake(self, value):
+        "Internal callback invoked when the wrapped suspend finishes"
+        if value is None:
+            value = (0, None)
+        elif value[0] == 1:
+            self._callback(value)
+            return
+        try:
+            value = (0, self.process(value[1]))
+        except Exception as exc:
+            value = (1, exc)
+        self._callback(value)
 
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
-        def inner_wake(value):
-            if value is None:
-                value = (0, None)
-            elif value[0] == 1:
-                wake(value)
-                return
-            try:
-                if self.process is not None:
-                    value = (0, self.process(value[1]))
-            except Exception as exc:
-                value = (1, exc)
-            wake(value)
-        self.children[0].apply(inner_wake, executor, routine)
+        if self.process is None:
+            # Nothing to do with the result; let it pass through directly.
+            self.children[0].apply(wake, executor, routine)
+            return
+        self._callback = wake
+        self.children[0].apply(self._inner_wake, executor, routine)
 
 class ControlSuspend(Suspend):
     """
@@ -496,6 +561,8 @@ class ControlSuspend(Suspend):
     correspond to control flow constructs
     """
 
+    __slots__ = ()
+
 class Trigger(ControlSuspend):
     """
     Trigger(*triggers) -> new instance
@@ -514,18 +581,17 @@ class Trigger(ControlSuspend):
     on some predefined tag.
     """
 
+    __slots__ = ('triggers', '_pairs')
+
     def __init__(self, *triggers):
         "Initializer; see class docstring for details"
         self.triggers = triggers
+        self._pairs = [(trig[0], (0, trig[1])) if isinstance(trig, tuple)
+                       else (trig, (0, None)) for trig in triggers]
 
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
-        for trig in self.triggers:
-            if isinstance(trig, tuple):
-                tag, value = trig
-            else:
-                tag, value = trig, None
-            executor.trigger(tag, (0, value))
+        executor.trigger_many(self._pairs)
         wake((0, None))
 
 class Exit(ControlSuspend):
@@ -542,6 +608,8 @@ class Exit(ControlSuspend):
     coroutines.
     """
 
+    __slots__ = ('result',)
+
     def __init__(self, result=None):
         "Initializer; see class docstring for details"
         self.result = result
@@ -565,6 +633,8 @@ class Spawn(ControlSuspend):
     once.
     """
 
+    __slots__ = ('target', 'daemon')
+
     def __init__(self, target, daemon=False):
         "Initializer; see class docstring for details"
         self.target = target
@@ -588,6 +658,8 @@ class CallbackSuspend(ControlSuspend):
     to require a dedicated suspend class.
     """
 
+    __slots__ = ('callback',)
+
     def __init__(self, callback):
         "Initializer; see class docstring for details"
         self.callback = callback
@@ -616,6 +688,8 @@ class SimpleCancellable(Suspend):
     which is used by cancel() to undo any changes performed in apply().
     """
 
+    __slots__ = ('cancelled', '_cancel_cb')
+
     def __init__(self):
         "Initializer; see class docstring for details"
         self.cancelled = False
@@ -641,11 +715,12 @@ class SimpleCancellable(Suspend):
         when the executor triggers the given target.
 
         This invokes executor's listen() method on target and callback, and
-        sets the _cancel_cb instance attribute to an anonymous function that
-        invokes the executor's stop_listening() on them.
+        sets the _cancel_cb instance attribute to a partial application of
+        the executor's stop_listening() to them.
         """
         executor.listen(target, callback)
-        self._cancel_cb = lambda: executor.stop_listening(target, callback)
+        self._cancel_cb = functools.partial(executor.stop_listening, target,
+                                            callback)
 
     def listen_reapply(self, wake, executor, routine, target):
         """
@@ -657,7 +732,11 @@ class SimpleCancellable(Suspend):
         apply() method with the given arguments when the target is triggered.
         """
         self.listen(executor, target,
-                    lambda v: self.apply(wake, executor, routine))
+                    functools.partial(self._reapply, wake, executor, routine))
+
+    def _reapply(self, wake, executor, routine, value):
+        "Internal helper for listen_reapply()"
+        self.apply(wake, executor, routine)
 
 class Call(ControlSuspend, SimpleCancellable):
     """
@@ -672,8 +751,11 @@ class Call(ControlSuspend, SimpleCancellable):
     conditions. The same object may not be used as a coroutine more than once.
     """
 
+    __slots__ = ('target', 'daemon')
+
     def __init__(self, target, daemon=False):
         "Initializer; see class docstring for details"
+        SimpleCancellable.__init__(self)
         self.target = target
         self.daemon = daemon
 
@@ -698,6 +780,8 @@ class Listen(ControlSuspend, SimpleCancellable):
     triggers.
     """
 
+    __slots__ = ('target',)
+
     def __init__(self, target):
         "Initializer; see class docstring for details"
         SimpleCancellable.__init__(self)
@@ -716,6 +800,8 @@ class Join(Listen):
     Python's threading module.
     """
 
+    __slots__ = ()
+
 class Sleep(SimpleCancellable):
     """
     Sleep(waketime, absolute=False) -> new instance
@@ -725,35 +811,30 @@ class Sleep(SimpleCancellable):
     If absolute is true, waketime is interpreted as a UNIX timestamp (in
     seconds) after which to wake the routine; otherwise, it is interpreted
     relative to the current time. The "waketime" instance attribute always
-    holds an absolute timestamp.
+    holds an absolute timestamp; the "queued" instance attribute tells
+    whether the sleep is waiting in an executor's queue.
     """
 
+    __slots__ = ('waketime', 'queued')
+
     def __init__(self, waketime, absolute=False):
         "Initializer; see class docstring for details"
         if not absolute: waketime += time.time()
         SimpleCancellable.__init__(self)
         self.waketime = waketime
-
-    def __hash__(self):
-        return hash((self.waketime, id(self)))
-
-    def __lt__(self, other):
-        return (self.waketime, id(self)) <  (other.waketime, id(other))
-    def __le__(self, other):
-        return (self.waketime, id(self)) <= (other.waketime, id(other))
-    def __eq__(self, other):
-        return (self.waketime, id(self)) == (other.waketime, id(other))
-    def __ne__(self, other):
-        return (self.waketime, id(self)) != (other.waketime, id(other))
-    def __ge__(self, other):
-        return (self.waketime, id(self)) >= (other.waketime, id(other))
-    def __gt__(self, other):
-        return (self.waketime, id(self)) >  (other.waketime, id(other))
+        self.queued = False
 
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
         executor.add_sleep(self)
-        self.listen(executor, self, wake)
+        executor.listen(self, wake)
+        self._cancel_cb = functools.partial(self._withdraw, executor, wake)
+
+    def _withdraw(self, executor, wake):
+        "Internal helper for cancel()"
+        executor.stop_listening(self, wake)
+        # A sleep taken off the queue to be woken must not be counted.
+        if self.queued: executor.remove_sleep(self)
 
 class IOSuspend(SimpleCancellable):
     """
@@ -771,6 +852,8 @@ class IOSuspend(SimpleCancellable):
     used to wait for a file descriptor's readiness.
     """
 
+    __slots__ = ('selectfile', 'mode', '_index', '_callback')
+
     SELECT_MODES = {'r': 0, 'w': 1, 'x': 2}
 
     def __init__(self, selectfile, mode):
@@ -780,6 +863,8 @@ class IOSuspend(SimpleCancellable):
         SimpleCancellable.__init__(self)
         self.selectfile = selectfile
         self.mode = mode
+        self._index = self.SELECT_MODES[mode]
+        self._callback = None
 
     def do_io(self, mode):
         """
@@ -796,19 +881,23 @@ class IOSuspend(SimpleCancellable):
         """
         return None
 
+    def _io_wake(self, value):
+        "Internal callback invoked when the select loop reports readiness"
+        if value is not None and value[0] == 1:
+            self._callback(value)
+            return
+        try:
+            result = self.do_io(value[1])
+        except IOError as exc:
+            self._callback((1, exc))
+        else:
+            self._callback((0, result))
+
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
-        def inner_wake(value):
-            if value is not None and value[0] == 1:
-                wake(value)
-                return
-            try:
-                result = self.do_io(value[1])
-                wake((0, result))
-            except IOError as exc:
-                wake((1, exc))
-        executor.add_select(self.selectfile, self.SELECT_MODES[self.mode])
-        self.listen(executor, self.selectfile, inner_wake)
+        self._callback = wake
+        executor.add_select(self.selectfile, self._index)
+        self.listen(executor, self.selectfile, self._io_wake)
 
 class ReadFile(IOSuspend):
     """
@@ -821,22 +910,24 @@ class ReadFile(IOSuspend):
     passed on to IOSuspend's initializer and defaults to readfile.
     """
 
+    __slots__ = ('readfile', 'length', '_read')
+
     def __init__(self, readfile, length, selectfile=None):
         "Initializer; see class docstring for details"
         if selectfile is None: selectfile = readfile
         IOSuspend.__init__(self, selectfile, 'r')
         self.readfile = readfile
         self.length = length
+        if hasattr(readfile, 'read'):
+            self._read = readfile.read
+        elif hasattr(readfile, 'recv'):
+            self._read = readfile.recv
+        else:
+            self._read = functools.partial(os.read, readfile)
 
     def do_io(self, mode):
         "Perform I/O; see class docstring for details"
-        try:
-            return self.readfile.read(self.length)
-        except AttributeError:
-            try:
-                return self.readfile.recv(self.length)
-            except AttributeError:
-                return os.read(self.readfile, self.length)
+        return self._read(self.length)
 
 class WriteFile(IOSuspend):
     """
@@ -849,22 +940,24 @@ class WriteFile(IOSuspend):
     is passed on to IOSuspend's initializer and defaults to writefile.
     """
 
+    __slots__ = ('writefile', 'data', '_write')
+
     def __init__(self, writefile, data, selectfile=None):
         "Initializer; see class docstring for details"
         if selectfile is None: selectfile = writefile
         IOSuspend.__init__(self, selectfile, 'w')
         self.writefile = writefile
         self.data = data
+        if hasattr(writefile, 'write'):
+            self._write = writefile.write
+        elif hasattr(writefile, 'send'):
+            self._write = writefile.send
+        else:
+            self._write = functools.partial(os.write, writefile)
 
     def do_io(self, mode):
         "Perform I/O; see class docstring for details"
-        try:
-            return self.writefile.write(self.data)
-        except AttributeError:
-            try:
-                return self.writefile.send(self.data)
-            except AttributeError:
-                return os.write(self.writefile, self.data)
+        return self._write(self.data)
 
 class AcceptSocket(IOSuspend):
     """
@@ -875,6 +968,8 @@ class AcceptSocket(IOSuspend):
     sock should be a socket.socket object; selectfile defaults to it.
     """
 
+    __slots__ = ('sock',)
+
     def __init__(self, sock, selectfile=None):
         "Initializer; see class docstring for details"
         if selectfile is None: selectfile = sock
@@ -890,6 +985,8 @@ class UtilitySuspend(Suspend):
     An umbrella class covering miscellaneous suspends
     """
 
+    __slots__ = ()
+
 class ReadAll(UtilitySuspend):
     """
     ReadAll(readfile, length, selectfile=None) -> new instance
@@ -900,12 +997,14 @@ class ReadAll(UtilitySuspend):
     The arguments are the same as for ReadFile.
     """
 
+    __slots__ = ('readfile', 'length', 'selectfile', 'read')
+
     def __init__(self, readfile, length, selectfile=None):
         "Initializer; see class docstring for details"
         self.readfile = readfile
         self.length = length
         self.selectfile = selectfile
-        self.read = None
+        self.read = bytearray()
 
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
@@ -913,22 +1012,19 @@ class ReadAll(UtilitySuspend):
             if result is not None and result[0] == 1:
                 wake(result)
                 return
-            elif result is None:
-                result = (0, result)
-            if self.read is None:
-                self.read = result[1]
-            else:
-                self.read += result[1]
-            if result[1]:
-                self.apply(wake, executor, routine)
-            else:
-                wake((0, self.read))
-        length = 0 if self.read is None else len(self.read)
-        if length == self.length:
-            wake((0, self.read))
+            elif result is not None and result[1]:
+                self.read.extend(result[1])
+                remaining = self.length - len(self.read)
+                if remaining > 0:
+                    delegate.length = remaining
+                    delegate.apply(inner_wake, executor, routine)
+                    return
+            wake((0, bytes(self.read)))
+        remaining = self.length - len(self.read)
+        if remaining <= 0:
+            wake((0, bytes(self.read)))
             return
-        delegate = ReadFile(self.readfile, self.length - length,
-                            self.selectfile)
+        delegate = ReadFile(self.readfile, remaining, self.selectfile)
         delegate.apply(inner_wake, executor, routine)
 
 class WriteAll(UtilitySuspend):
@@ -941,6 +1037,8 @@ class WriteAll(UtilitySuspend):
     same as for WriteFile.
     """
 
+    __slots__ = ('writefile', 'data', 'selectfile', 'written')
+
     def __init__(self, writefile, data, selectfile=None):
         "Initializer; see class docstring for details"
         self.writefile = writefile
@@ -950,20 +1048,42 @@ class WriteAll(UtilitySuspend):
 
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
+        # After a partial write, the remainder is written from slices of a
+        # memoryview (which do not copy the data). The view is only created
+        # then and released before waking the caller, who might want to
+        # resize a bytearray passed as data right afterwards.
+        view = []
+        def finish(value):
+            data, delegate.data = delegate.data, None
+            if view:
+                base = view.pop()
+                if hasattr(base, 'release'): # Py3K
+                    data.release()
+                    base.release()
+            wake(value)
         def inner_wake(result):
             if result is not None and result[0] == 1:
-                wake(result)
+                finish(result)
                 return
             elif result is None or result[1] is None:
                 self.written = len(self.data)
             else:
                 self.written += result[1]
-            self.apply(wake, executor, routine)
+            if self.written == len(self.data):
+                finish((0, self.written))
+                return
+            if not view: view.append(memoryview(self.data))
+            delegate.data = view[0][self.written:]
+            delegate.apply(inner_wake, executor, routine)
         if self.written == len(self.data):
             wake((0, self.written))
             return
-        delegate = WriteFile(self.writefile, self.data[self.written:],
-                             self.selectfile)
+        if self.written:
+            view.append(memoryview(self.data))
+            data = view[0][self.written:]
+        else:
+            data = self.data
+        delegate = WriteFile(self.writefile, data, self.selectfile)
         delegate.apply(inner_wake, executor, routine)
 
 class SpawnProcess(UtilitySuspend):
@@ -976,17 +1096,55 @@ class SpawnProcess(UtilitySuspend):
     to the caller. If the coroutine executor has been prepared for signal
     reception using set_sigpipe(), the process is registered to be wait()-ed
     upon whenever thec process hosting the executor receives a SIGCHLD.
+
+    If params specify a bare program name as the first element of an args
+    list (and no shell or executable), the program's absolute location is
+    remembered for later spawns of the same program with the same search
+    path, which is the PATH of env if that is given and the PATH of the
+    current process otherwise (where supported by the os and shutil
+    modules). If the remembered location cannot be executed, it is forgotten
+    and the search path is searched anew.
     """
 
+    __slots__ = ('params', '_program')
+
     def __init__(self, **params):
         "Initializer; see class docstring for details"
+        args = params.get('args')
+        if (isinstance(args, (list, tuple)) and args and
+                params.get('executable') is None and
+                not params.get('shell')):
+            self._program = args[0]
+        else:
+            self._program = None
         self.params = params
 
+    def _spawn(self):
+        "Internal helper: Create the child process"
+        params = self.params
+        if self._program is None:
+            return subprocess.Popen(**params)
+        path, key = _resolve_program(self._program, params.get('env'))
+        if path is None:
+            return subprocess.Popen(**params)
+        try:
+            return subprocess.Popen(executable=path, **params)
+        except OSError as exc:
+            # The program might have been moved, removed, or replaced since
+            # it was looked up; let Popen search by itself instead. Other
+            # errors (such as a bad cwd) are not retried.
+            if (exc.errno not in (errno.ENOENT, errno.EACCES,
+                                  errno.ENOEXEC) or
+                    exc.filename != path):
+                raise
+            _EXEC_CACHE.pop(key, None)
+            return subprocess.Popen(**params)
+
     def apply(self, wake, executor, routine):
         "Apply this suspend; see class docstring for details"
-        proc = subprocess.Popen(**self.params)
+        proc = self._spawn()
         if hasattr(executor, 'waits'):
-            executor.waits.add(proc)
+            executor.waits[proc.pid] = proc
         wake((0, proc))
 
 class WaitProcess(UtilitySuspend, SimpleCancellable):
@@ -1007,6 +1165,8 @@ class WaitProcess(UtilitySuspend, SimpleCancellable):
     using set_sigpipe(), applying this raises a RuntimeError.
     """
 
+    __slots__ = ('target',)
+
     def __init__(self, target):
         "Initializer; see class docstring for details"
         SimpleCancellable.__init__(self)
@@ -1022,7 +1182,7 @@ class WaitProcess(UtilitySuspend, SimpleCancellable):
             if res is not None:
                 wake((0, res))
                 return
-            executor.waits.add(self.target)
+            executor.waits[self.target.pid] = self.target
             eff_target = ProcessTag(self.target.pid)
         elif isinstance(self.target, int):
             eff_target = ProcessTag(self.target)
@@ -1050,14 +1210,36 @@ class Executor:
       calling the run() method or by calling the Executor object itself.
     """
 
-    def __init__(self):
-        "Initializer; see class docstring for details"
+    # Event masks corresponding to the select() parameter indices when epoll
+    # is used; see _poll().
+    if hasattr(select, 'epoll'):
+        POLL_MASKS = (select.EPOLLIN, select.EPOLLOUT, select.EPOLLPRI)
+    else:
+        POLL_MASKS = None
+
+    def __init__(self, epoll=True):
+        """
+        Initializer; see class docstring for details
+
+        If epoll is true and the platform supports it, the select loop is
+        backed by select.epoll() (with file descriptors remaining registered
+        between waits) instead of select.select().
+        """
         self.routines = {}
+        self._wakes = {}
         self.daemons = set()
         self.suspended = set()
         self.listening = {}
         self.selectfiles = (set(), set(), set())
         self.sleeps = []
+        self._sleep_buckets = {}
+        self._sleep_count = 0
+        self._sleeps_cancelled = 0
+        self._use_epoll = bool(epoll and self.POLL_MASKS is not None)
+        self._epoll = None
+        self._pollfds = {}
+        self._pollfiles = {}
+        self._pollready = set()
         self.error_cb = None
 
     def add(self, routine, value=None, daemon=False):
@@ -1085,6 +1267,7 @@ class Executor:
         """
         self.suspended.discard(routine)
         self.daemons.discard(routine)
+        self._wakes.pop(routine, None)
         return self.routines.pop(routine, None)
 
     def _suspend(self, routine):
@@ -1114,7 +1297,8 @@ class Executor:
         receives exactly one argument -- the "associated value" --, which is
         specified when the event is triggered. A particular callback may be
         registered for an event at most once. All callbacks are removed after
-        an event is triggered (and must be re-added as necessary).
+        an event is triggered (and must be re-added as necessary); they are
+        invoked in the order in which they were registered.
 
         The built-in triggers follow the "two return channels" convention: The
         associated value is either 2-tuple (code, value) or the None singleton
@@ -1124,17 +1308,30 @@ class Executor:
         is an arbitrary object if code is 0 or an instance of BaseException if
         code is 1.
         """
-        try:
-            self.listening[event].add(callback)
-        except KeyError:
-            self.listening[event] = set((callback,))
+        # Most events only ever have a single listener, which is stored
+        # as-is; a list is only created for the second one.
+        callbacks = self.listening.get(event)
+        if callbacks is None:
+            self.listening[event] = callback
+        elif callbacks.__class__ is list:
+            callbacks.append(callback)
+        else:
+            self.listening[event] = [callbacks, callback]
 
     def stop_listening(self, event, callback):
         """
-        Remove the given callback from event's listener set
+        Remove the given callback from event's listeners
         """
-        if event not in self.listening: return
-        self.listening[event].discard(callback)
+        callbacks = self.listening.get(event)
+        if callbacks is None:
+            return
+        elif callbacks.__class__ is not list:
+            if callbacks == callback: del self.listening[event]
+            return
+        try:
+            callbacks.remove(callback)
+        except ValueError:
+            pass
 
     def trigger(self, event, result=None):
         """
@@ -1143,11 +1340,48 @@ class Executor:
         Returns the amount of callbacks that were invoked. See listen() for a
         description of permissible associated values.
         """
-        callbacks = self.listening.pop(event, ())
+        # Equivalent to _run_callback(cb, (result,), final=True) for each
+        # callback, without the per-call overhead.
+        callbacks = self.listening.pop(event, None)
+        if callbacks is None:
+            return 0
+        elif callbacks.__class__ is not list:
+            try:
+                callbacks(result)
+            except Exception as exc:
+                self.on_error(exc, callbacks)
+            return 1
         for cb in callbacks:
-            self._run_callback(cb, (result,), final=True)
+            try:
+                cb(result)
+            except Exception as exc:
+                self.on_error(exc, cb)
         return len(callbacks)
 
+    def trigger_many(self, pairs):
+        """
+        Trigger multiple events with their associated values
+
+        pairs is an iterable of (event, result) 2-tuples, which are processed
+        in order as if trigger() were invoked on each. Returns the total amount
+        of callbacks that were invoked.
+        """
+        listening = self.listening
+        count = 0
+        for event, result in pairs:
+            callbacks = listening.pop(event, None)
+            if callbacks is None:
+                continue
+            elif callbacks.__class__ is not list:
+                callbacks = (callbacks,)
+            for cb in callbacks:
+                try:
+                    cb(result)
+                except Exception as exc:
+                    self.on_error(exc, cb)
+            count += len(callbacks)
+        return count
+
     def add_select(self, file, index):
         """
         Register file to be selected upon in category index
@@ -1163,6 +1397,8 @@ class Executor:
         again.
         """
         self.selectfiles[index].add(file)
+        if self._use_epoll:
+            self._poll_add(file, index)
 
     def remove_selects(self, *files):
         """
@@ -1176,6 +1412,8 @@ class Executor:
         self.selectfiles[0].difference_update(files)
         self.selectfiles[1].difference_update(files)
         self.selectfiles[2].difference_update(files)
+        if self._use_epoll:
+            self._poll_remove(files)
         result = (1, EOFError('File closed'))
         for f in files: self.trigger(f, result)
 
@@ -1188,29 +1426,255 @@ class Executor:
         for f in writable: self.trigger(f, (0, 'w'))
         for f in exceptable: self.trigger(f, (0, 'x'))
 
+    def _poll_add(self, file, index):
+        "Internal helper for registering file with the epoll object"
+        fd = file if isinstance(file, int) else file.fileno()
+        if self._epoll is None:
+            self._epoll = select.epoll()
+        entry = self._pollfds.get(fd)
+        if entry is None:
+            entry = self._pollfds[fd] = [0, [], [], []]
+            ops = (self._epoll.register, self._epoll.modify)
+        else:
+            ops = (self._epoll.modify, self._epoll.register)
+        # Distinct objects can stand for the same descriptor (such as a
+        # socket and its fileno()); all of them are reported when it becomes
+        # ready.
+        files = entry[index + 1]
+        if file not in files: files.append(file)
+        # Files might not know their descriptor anymore once they are closed
+        # (which is when remove_selects() is typically called).
+        self._pollfiles[file] = fd
+        mask = entry[0] = entry[0] | self.POLL_MASKS[index]
+        # Registrations are one-shot so that a file which is not waited
+        # upon anymore does not keep the loop busy; they are re-armed here
+        # (even if the mask is unchanged, since the file might have been
+        # closed while armed and the descriptor reused by another one).
+        # The kernel drops registrations of closed files behind our back,
+        # so the other operation is tried if the first one fails.
+        # Regular files cannot be registered at all (while select() always
+        # reports them as ready); they are reported by _poll() right away.
+        try:
+            try:
+                ops[0](fd, mask | select.EPOLLONESHOT)
+            except (IOError, OSError) as exc:
+                if exc.errno not in (errno.EEXIST, errno.ENOENT): raise
+                ops[1](fd, mask | select.EPOLLONESHOT)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.EPERM: raise
+            self._pollready.add(fd)
+
+    def _poll_remove(self, files):
+        "Internal helper for unregistering files from the epoll object"
+        for file in files:
+            fd = self._pollfiles.pop(file, None)
+            entry = self._pollfds.get(fd)
+            if entry is None or not (file in entry[1] or file in entry[2] or
+                                     file in entry[3]):
+                continue
+            # Any other objects standing for the descriptor are gone with it.
+            del self._pollfds[fd]
+            self._pollready.discard(fd)
+            for files in entry[1:]:
+                for f in files: self._pollfiles.pop(f, None)
+            # The file might have been closed already.
+            try:
+                self._epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def _select(self, timeout):
+        "Internal helper for waiting using select.select()"
+        sf = self.selectfiles
+        try:
+            result = select.select(sf[0], sf[1], sf[2], timeout)
+        except select.error as e:
+            if hasattr(e, 'errno'): # Py3K
+                if e.errno != errno.EINTR: raise
+            else: # Py2K
+                if e.args[0] != errno.EINTR: raise
+        else:
+            self._done_select(*result)
+
+    def _poll(self, timeout):
+        "Internal helper for waiting on the epoll object"
+        pollfds, pollfiles = self._pollfds, self._pollfiles
+        ready = self._pollready
+        if ready:
+            timeout = 0
+        elif timeout is None:
+            timeout = -1
+        try:
+            events = self._epoll.poll(timeout)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.EINTR: raise
+            return
+        if ready:
+            events = list(events)
+            events.extend((fd, pollfds[fd][0]) for fd in ready
+                          if fd in pollfds)
+            ready.clear()
+        result, masks = ([], [], []), self.POLL_MASKS
+        for fd, ev in events:
+            entry = pollfds.get(fd)
+            if entry is None: continue
+            # Like select(), report errors and hangups as readiness for
+            # whatever the file is waited upon for.
+            if ev & (select.EPOLLERR | select.EPOLLHUP):
+                ev |= entry[0]
+            for i in (0, 1, 2):
+                if ev & entry[0] & masks[i]:
+                    files = entry[i + 1]
+                    result[i].extend(files)
+                    entry[i + 1] = []
+                    for file in files:
+                        if not (file in entry[1] or file in entry[2] or
+                                file in entry[3]):
+                            pollfiles.pop(file, None)
+            entry[0] &= ~ev
+            if not entry[0]: continue
+            try:
+                self._epoll.modify(fd, entry[0] | select.EPOLLONESHOT)
+            except (IOError, OSError):
+                # Closed in the meantime; nothing to wait for anymore.
+                pass
+        self._done_select(*result)
+
     def add_sleep(self, sleep):
         """
         Register the given sleep with the executor
 
         sleep should be an instance of the Sleep suspend (or something having
-        a compatible API, i.e., having a waketime attribute as described for
-        Sleep, being hashable, and having comparison operators corresponding
-        to those of its waketime attribute).
+        a compatible API, i.e., having waketime, queued, and cancelled
+        attributes as described for Sleep and SimpleCancellable and being
+        hashable). The queued attribute is maintained by the executor.
+
+        Sleeps are grouped into buckets spanning 1/SLEEP_BUCKETS_PER_SECOND
+        seconds each, which are held in a priority queue with the earliest
+        bucket being "woken" first (within a bucket, sleeps are woken in
+        order of waketime, ties being broken in order of insertion); they
+        determine the timeout of the select() call or of a sleep() call when
+        there are no running coroutines. When a sleep's waketime has passed,
+        it is trigger()ed with an associated value of None. Cancelled sleeps
+        are not removed immediately; they are skipped (and eventually
+        discarded) instead; see also remove_sleep().
+        """
+        key = int(sleep.waketime * SLEEP_BUCKETS_PER_SECOND)
+        bucket = self._sleep_buckets.get(key)
+        if bucket is None:
+            self._sleep_buckets[key] = [sleep]
+            heapq.heappush(self.sleeps, key)
+        else:
+            bucket.append(sleep)
+        sleep.queued = True
+        self._sleep_count += 1
+        if sleep.cancelled: self._sleeps_cancelled += 1
 
-        Sleeps are held in a priority queue with the sleep with the smallest
-        waketime being "woken" first; they determine the timeout of the
-        select() call or of a sleep() call when there are no running
-        coroutines. When a sleep's waketime has passed, it is trigger()ed with
-        an associated value of None.
+    def remove_sleep(self, sleep):
         """
-        heapq.heappush(self.sleeps, sleep)
+        Notify the executor that the given (cancelled) sleep is not needed
+
+        sleep's cancelled and queued attributes must both be true, and sleep
+        must not have been passed to this method before. Cancelled sleeps are
+        only counted here; once they make up more than half of all sleeps,
+        they are purged from the queue in one go, so that many long sleeps
+        being cancelled (e.g. timeouts) do not pile up.
+        """
+        self._sleeps_cancelled += 1
+        if (self._sleeps_cancelled > 64 and
+                self._sleeps_cancelled * 2 > self._sleep_count):
+            self._purge_sleeps()
+
+    def _purge_sleeps(self):
+        "Internal helper dropping all cancelled sleeps"
+        buckets, count = self._sleep_buckets, 0
+        for key, bucket in tuple(buckets.items()):
+            live = []
+            for sleep in bucket:
+                if sleep.cancelled:
+                    sleep.queued = False
+                else:
+                    live.append(sleep)
+            if live:
+                buckets[key] = live
+                count += len(live)
+            else:
+                del buckets[key]
+        assert self._sleep_count - count == self._sleeps_cancelled, \
+            'cancelled sleep count out of sync'
+        self.sleeps[:] = buckets
+        heapq.heapify(self.sleeps)
+        self._sleep_count = count
+        self._sleeps_cancelled = 0
 
     def _finish_sleeps(self, now=None):
         "Internal function actually waking finished sleeps"
         if now is None: now = time.time()
-        while self.sleeps and self.sleeps[0].waketime <= now:
-            sleep = heapq.heappop(self.sleeps)
-            self.trigger(sleep)
+        limit = now * SLEEP_BUCKETS_PER_SECOND
+        sleeps, buckets = self.sleeps, self._sleep_buckets
+        while sleeps and sleeps[0] <= limit:
+            key = sleeps[0]
+            bucket = buckets[key]
+            if len(bucket) > 1:
+                bucket.sort(key=operator.attrgetter('waketime'))
+            if key + 1 > limit:
+                # The bucket has not elapsed entirely; only wake those
+                # sleeps which are due.
+                n = 0
+                while n < len(bucket) and bucket[n].waketime <= now:
+                    n += 1
+                if n == 0: break
+                due, bucket[:n] = bucket[:n], ()
+                if bucket:
+                    self._sleep_count -= n
+                    self._detach_sleeps(due)
+                    for sleep in due:
+                        if not sleep.cancelled: self.trigger(sleep)
+                    break
+                bucket = due
+            heapq.heappop(sleeps)
+            del buckets[key]
+            self._sleep_count -= len(bucket)
+            self._detach_sleeps(bucket)
+            for sleep in bucket:
+                if not sleep.cancelled: self.trigger(sleep)
+
+    def _detach_sleeps(self, sleeps):
+        """
+        Internal helper marking sleeps taken off the queue
+
+        This must happen before any of them is woken, since waking one might
+        cancel another (which then must not be counted as cancelled anymore).
+        """
+        for sleep in sleeps:
+            sleep.queued = False
+            if sleep.cancelled: self._sleeps_cancelled -= 1
+
+    def _next_waketime(self):
+        """
+        Internal helper returning the earliest waketime of any sleep
+
+        Cancelled sleeps are disregarded (and buckets consisting only of them
+        are dropped); if there are no pending sleeps, None is returned.
+        """
+        sleeps, buckets = self.sleeps, self._sleep_buckets
+        while sleeps:
+            bucket = buckets[sleeps[0]]
+            if len(bucket) == 1 and not bucket[0].cancelled:
+                return bucket[0].waketime
+            live = []
+            for sleep in bucket:
+                if sleep.cancelled:
+                    sleep.queued = False
+                else:
+                    live.append(sleep)
+            self._sleep_count -= len(bucket) - len(live)
+            self._sleeps_cancelled -= len(bucket) - len(live)
+            if live:
+                if len(live) != len(bucket): bucket[:] = live
+                return min(s.waketime for s in live)
+            del buckets[heapq.heappop(sleeps)]
+        return None
 
     def on_error(self, exc, source):
         """
@@ -1250,10 +1714,21 @@ class Executor:
         for r in tuple(self.suspended):
             r.close()
         self.routines = {}
+        self._wakes = {}
         self.suspended = set()
         self.listening = {}
         self.sleeps = []
+        self._sleep_buckets = {}
+        self._sleep_count = 0
+        self._sleeps_cancelled = 0
         self.selectfiles = (set(), set(), set())
+        if self._epoll is not None:
+            # A new one is created once it is needed again.
+            self._epoll.close()
+            self._epoll = None
+        self._pollfds = {}
+        self._pollfiles = {}
+        self._pollready = set()
 
     def run(self):
         """
@@ -1267,8 +1742,6 @@ class Executor:
         def abort_routine(r, exc):
             if not self._done(r, (1, exc)):
                 self.on_error(exc, r)
-        def make_wake(routine):
-            return lambda value: self._wake(routine, value)
         while self.routines or self.suspended:
             if all_daemons():
                 break
@@ -1280,8 +1753,10 @@ class Executor:
                 # after the fact whether to run on_error() or not; as a bonus,
                 # we get a more precise error source.
                 try:
-                    resume = (r.send, r.throw)[v[0]]
-                    suspend = resume(v[1])
+                    if v[0]:
+                        suspend = r.throw(v[1])
+                    else:
+                        suspend = r.send(v[1])
                 except StopIteration:
                     self._done(r, None)
                     continue
@@ -1293,33 +1768,49 @@ class Executor:
                 elif isinstance(suspend, BaseException):
                     abort_routine(r, suspend)
                     continue
-                self._suspend(r)
-                res = self._run_callback(suspend.apply, (make_wake(r), self,
-                                                         r))
-                if res[0] == 1:
-                    self._wake(r, res)
+                # Inlined _suspend() (r is known to be running) and
+                # _run_callback(); many suspends (such as Trigger or Spawn)
+                # finish immediately, so this is about as hot as resuming.
+                del self.routines[r]
+                self.suspended.add(r)
+                # The wake-up callback is created once per routine and reused
+                # for all of its suspends.
+                wake = self._wakes.get(r)
+                if wake is None:
+                    wake = functools.partial(self._wake, r)
+                    self._wakes[r] = wake
+                try:
+                    suspend.apply(wake, self, r)
+                except Exception as exc:
+                    self._wake(r, (1, exc))
             if all_daemons():
                 break
+            # The earliest sleep might have expired while the coroutines were
+            # running; neither select() nor sleep() accepts the resulting
+            # negative timeouts (and epoll would block forever).
+            now = None
             if any(self.selectfiles):
                 if self.routines:
                     timeout = 0
-                elif self.sleeps:
-                    timeout = self.sleeps[0].waketime - time.time()
                 else:
-                    timeout = None
-                sf = self.selectfiles
-                try:
-                    result = select.select(sf[0], sf[1], sf[2], timeout)
-                except select.error as e:
-                    if hasattr(e, 'errno'): # Py3K
-                        if e.errno != errno.EINTR: raise
-                    else: # Py2K
-                        if e.args[0] != errno.EINTR: raise
+                    waketime = self._next_waketime()
+                    if waketime is None:
+                        timeout = None
+                    else:
+                        timeout = max(waketime - time.time(), 0)
+                if self._use_epoll:
+                    self._poll(timeout)
                 else:
-                    self._done_select(*result)
-            elif self.sleeps and not self.routines:
-                time.sleep(self.sleeps[0].waketime - time.time())
-            self._finish_sleeps()
+                    self._select(timeout)
+            elif not self.routines:
+                waketime = self._next_waketime()
+                if waketime is not None:
+                    now = time.time()
+                    if waketime > now:
+                        time.sleep(waketime - now)
+                        now = None
+            if self.sleeps:
+                self._finish_sleeps(now)
 
     def __call__(self, *args, **kwds):
         "Invoke this instance; an alias for run()"
@@ -1343,6 +1834,8 @@ class Lock(object):
     class _Acquire(SimpleCancellable):
         "Helper class representing an Acquire() operation; see there"
 
+        __slots__ = ('parent',)
+
         def __init__(self, parent):
             "Initializer"
             SimpleCancellable.__init__(self)
@@ -1350,17 +1843,18 @@ class Lock(object):
 
         def apply(self, wake, executor, routine):
             "Apply this suspend; see Acquire() for details"
-            if self.parent.locked:
-                self.listen_reapply(wake, executor, routine, self.parent)
+            parent = self.parent
+            if parent.locked:
+                self.listen_reapply(wake, executor, routine, parent)
             else:
-                self.parent.locked = True
-                self.parent._trigger = lambda: executor.trigger(self.parent)
+                parent.locked = True
+                parent._executor = executor
                 wake((0, None))
 
     def __init__(self):
         "Initializer; see class docstring for details"
         self.locked = False
-        self._trigger = None
+        self._executor = None
 
     def Acquire(self):
         """
@@ -1381,8 +1875,8 @@ class Lock(object):
         if not self.locked:
             raise RuntimeError('Releasing unlocked lock')
         self.locked = False
-        callback, self._trigger = self._trigger, None
-        callback()
+        executor, self._executor = self._executor, None
+        executor.trigger(self)
 
 class StateSwitcher(object):
     """
@@ -1402,6 +1896,8 @@ class StateSwitcher(object):
     class _Wait(SimpleCancellable):
         "Helper class representing a Wait() operation; see there"
 
+        __slots__ = ('parent', 'match')
+
         def __init__(self, parent, match):
             "Initializer"
             SimpleCancellable.__init__(self)
@@ -1418,6 +1914,8 @@ class StateSwitcher(object):
     class _Toggle(SimpleCancellable):
         "Helper class representing a Toggle() operation; see there"
 
+        __slots__ = ('parent', 'match', 'new', 'wait')
+
         def __init__(self, parent, match, new, wait):
             "Initializer"
             SimpleCancellable.__init__(self)
@@ -1440,6 +1938,8 @@ class StateSwitcher(object):
     class _Set(Suspend):
         "Helper class representing a Set() operation; see there"
 
+        __slots__ = ('parent', 'new')
+
         def __init__(self, parent, new):
             "Initializer"
             self.parent = parent
@@ -1495,7 +1995,9 @@ class BinaryLineReader(object):
 
     Data are read in (binary) chunks whose size is defermined by the
     chunk_size instance attribute; it defaults to the LINEREADER_CHUNK_SIZE
-    module-level constant.
+    module-level constant. While a single line spans multiple chunks, the
+    chunk size is doubled after each chunk up to LINEREADER_MAX_CHUNK_SIZE
+    (or chunk_size, if that is larger).
 
     Line splitting is performed on line feed (0x0A) bytes *before* data are
     decoded. This class avoids the potential blocking of file object methods
@@ -1506,6 +2008,8 @@ class BinaryLineReader(object):
     class _ReadLine(Suspend):
         "Helper class for ReadLine(); see there"
 
+        __slots__ = ('parent', '_delegate')
+
         def __init__(self, parent):
             "Initializer"
             self.parent = parent
@@ -1513,23 +2017,38 @@ class BinaryLineReader(object):
 
         def apply(self, wake, executor, routine):
             "Apply this suspend; see ReadLine() for details"
+            line = self.parent._extract_line()
+            if line is not None:
+                wake((0, line))
+                return
+            self._read(wake, executor, routine)
+
+        def _read(self, wake, executor, routine):
+            "Helper: Read data until a line is complete"
+            parent = self.parent
             def inner_wake(result):
                 if result[0] == 1:
+                    self._delegate = None
                     wake(result)
                     return
                 elif result[1]:
-                    self.parent._buffer += result[1]
+                    parent._buffer += result[1]
                 else:
-                    self.parent._eof = True
-                self._delegate = None
-                self.apply(wake, executor, routine)
-            line = self.parent._extract_line()
-            if line is not None:
-                wake((0, line))
-                return
-            self._delegate = ReadFile(self.parent.file,
-                                      self.parent.chunk_size)
-            self._delegate.apply(inner_wake, executor, routine)
+                    parent._eof = True
+                line = parent._extract_line()
+                if line is not None:
+                    self._delegate = None
+                    wake((0, line))
+                    return
+                # Long lines are read in increasingly large chunks; the
+                # same delegate is re-armed instead of re-entering apply().
+                if delegate.length < LINEREADER_MAX_CHUNK_SIZE:
+                    delegate.length = min(delegate.length * 2,
+                                          LINEREADER_MAX_CHUNK_SIZE)
+                delegate.apply(inner_wake, executor, routine)
+            delegate = ReadFile(parent.file, parent.chunk_size)
+            self._delegate = delegate
+            delegate.apply(inner_wake, executor, routine)
 
         def cancel(self):
             if self._delegate is not None:
@@ -1541,18 +2060,28 @@ class BinaryLineReader(object):
         self.encoding = encoding
         self.errors = errors
         self.chunk_size = LINEREADER_CHUNK_SIZE
-        self._buffer = b''
+        self._buffer = bytearray()
+        self._scanned = 0
         self._eof = False
 
     def _extract_line(self):
         "Helper: Extract (and decode) a line from the buffer or return None"
-        line, sep, rest = self._buffer.partition(b'\n')
-        if not sep and not self._eof:
+        buf = self._buffer
+        # Do not scan the beginning of an incomplete line again and again.
+        end = buf.find(b'\n', self._scanned)
+        if end != -1:
+            end += 1
+        elif not self._eof:
+            self._scanned = len(buf)
             return None
-        self._buffer = rest
-        line += sep
+        else:
+            end = len(buf)
+        line = bytes(buf[:end])
+        # Removing data from the front of a bytearray is cheap.
+        del buf[:end]
+        self._scanned = 0
         if self.encoding is not None:
-            line = line.decode(self.encoding, self.errors)
+            line = line.decode(self.encoding, self.errors or 'strict')
         return line
 
     def ReadLine(self):
@@ -1564,6 +2093,32 @@ class BinaryLineReader(object):
         """
         return self._ReadLine(self)
 
+def _resolve_program(name, env=None):
+    """
+    Internal helper for SpawnProcess: Return the cached location of name
+
+    The location is looked up in the search path subprocess would use for
+    the given environment (None meaning that of the current process), and
+    cached per search path. Returns a (path, key) tuple, where key is the
+    cache key; if name is not a bare program name, if it cannot be found in
+    the search path (or not as an absolute path), or if the os and shutil
+    modules lack the necessary functions, both are None.
+    """
+    get_exec_path = getattr(os, 'get_exec_path', None)
+    which = getattr(shutil, 'which', None)
+    if (which is None or get_exec_path is None or
+            not isinstance(name, str) or not name or os.sep in name):
+        return (None, None)
+    search = os.pathsep.join(get_exec_path(env))
+    key = (name, search)
+    path = _EXEC_CACHE.get(key)
+    if path is None:
+        path = which(name, path=search)
+        if path is None or not os.path.isabs(path):
+            return (None, None)
+        _EXEC_CACHE[key] = path
+    return (path, key)
+
 def make_nonblocking(fp):
     """
     Make fp non-blocking
@@ -1587,9 +2142,10 @@ def sigpipe_handler(rfd, waits, cleanup):
 
     This is expected to do the following things in a loop:
     - Read from rfd.
-    - Invoke the poll() method of every object in waits (which is a set) and
-      discard those objects whose poll() method does not return None.
-    - Employ os.waitpid() to wait for any stray child processes.
+    - Employ os.waitpid() to reap all finished child processes.
+    - Discard the entries of waits (which is a dictionary mapping PID-s to
+      subprocess.Popen instances) whose processes have been reaped, storing
+      the exit codes into the returncode attributes of the Popen objects.
     - Trigger ProcessTag-s constructed from the PID-s of all finished child
       processes with the respective exit codes as associated values.
     When the coroutine is terminated, it is expected to invoke the cleanup()
@@ -1598,12 +2154,7 @@ def sigpipe_handler(rfd, waits, cleanup):
     try:
         while 1:
             yield ReadFile(rfd, SIGPIPE_CHUNK_SIZE)
-            wakelist = []
-            for w in tuple(waits):
-                res = w.poll()
-                if res is not None:
-                    waits.remove(w)
-                    wakelist.append((ProcessTag(w.pid), res))
+            reaped = {}
             while 1:
                 try:
                     pid, status = os.waitpid(-1, os.WNOHANG)
@@ -1618,8 +2169,18 @@ def sigpipe_handler(rfd, waits, cleanup):
                     code = -os.WTERMSIG(status)
                 else:
                     continue
-                wakelist.append((ProcessTag(pid), code))
-            yield Trigger(*wakelist)
+                reaped[pid] = code
+            if not reaped:
+                continue
+            # The processes have been reaped by waitpid() above, so their
+            # Popen objects must be told about their exit codes (a poll()
+            # would not find them anymore).
+            for pid, code in reaped.items():
+                w = waits.pop(pid, None)
+                if w is not None and w.returncode is None:
+                    w.returncode = code
+            yield Trigger(*[(ProcessTag(pid), code)
+                            for pid, code in reaped.items()])
     finally:
         cleanup()
 
@@ -1639,8 +2200,8 @@ def set_sigpipe(executor, coroutine=sigpipe_handler):
     additionally, signal.set_wakeup_fd() is used to wake up the executor's
     select loop whenever a signal arrives. Since these are global state, this
     is a module-level function. The executor gains a "waits" attribute, which
-    is a set of subprocess.Popen instances to be regularly polled for having
-    finished by coroutine.
+    is a dictionary mapping PID-s to subprocess.Popen instances to be
+    notified by coroutine when their processes finish.
     """
     def cleanup(reset_signals=True):
         "Callback for cleaning up when the executor is shut down"
@@ -1657,7 +2218,7 @@ def set_sigpipe(executor, coroutine=sigpipe_handler):
         except AttributeError:
             pass
     rfd, wfd = os.pipe()
-    waits = set()
+    waits = {}
     try:
         make_nonblocking(wfd)
         signal.set_wakeup_fd(wfd)
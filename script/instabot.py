@@ -7,7 +7,7 @@ A bot library for Instant.
 
 import sys, os, io, re, time, stat
 import traceback
-import collections, heapq, ast
+import collections, heapq, itertools, ast
 import json
 import socket
 import threading
@@ -19,12 +19,46 @@ try:
 except ImportError:
     from Queue import Queue, Empty as QueueEmpty
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 VERSION = 'v1.5.5'
 
 RELAXED_COOKIES = bool(os.environ.get('INSTABOT_RELAXED_COOKIES'))
 
 _unicode = websocket_server.compat.unicode
 
+def _decode_json(text):
+    """
+    Internal: Parse the given JSON text, using orjson if it is available.
+
+    Input orjson rejects (including malformed input) is passed on to the
+    standard library, which also provides the exception for invalid input.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except ValueError:
+            pass
+    return json.loads(text)
+
+def _encode_json(obj):
+    """
+    Internal: Serialize obj into compact JSON, using orjson if it is
+    available.
+
+    Objects orjson cannot handle (such as non-string dictionary keys or
+    integers exceeding 64 bits) are passed on to the standard library.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(',', ':'))
+
 class EventScheduler(object):
     """
     EventScheduler(time=None, sleep=None) -> new instance
@@ -32,12 +66,13 @@ class EventScheduler(object):
     An EventScheduler executes callbacks at dynamically specified times.
 
     time is a function that returns the current time as a floating-point
-    number; the default implementation returns the current UNIX time. sleep
-    is a function that takes a single floating-point argument or None, blocks
-    the calling thread for that time (where None means "arbitrarily long"),
-    and returns whether there is anything to be done in the EventScheduler's
-    queue; the default implementation does this in such a way that it can be
-    interrupted by concurrent callback submissions.
+    number; the default implementation reads a monotonic clock (or returns
+    the current UNIX time where there is none). sleep is a function that
+    takes a single floating-point argument or None, blocks the calling thread
+    for that time (where None means "arbitrarily long"), and returns whether
+    there is anything to be done in the EventScheduler's queue; the default
+    implementation does this in such a way that it can be interrupted by
+    concurrent callback submissions.
 
     As the requirements suggest, specifying a non-default implementation for
     sleep would be unwise; therefore, time should use the same time units as
@@ -110,17 +145,22 @@ class EventScheduler(object):
         self.sleep = sleep
         self.forever = True
         self.running = False
-        self.cond = threading.Condition()
-        self._seq = 0
+        lock = threading.RLock()
+        self.cond = threading.Condition(lock)
+        # join() waits on a separate condition sharing the lock, so the only
+        # thread ever waiting on cond is the one inside run(), and waking it
+        # needs only a notify().
+        self._stopped = threading.Condition(lock)
+        self._seq = itertools.count()
     def __enter__(self):
         "Context manager entry; internal."
         return self.cond.__enter__()
     def __exit__(self, *args):
         "Context manager exit; internal."
         return self.cond.__exit__(*args)
-    def _time(self):
-        "Internal: Default implementation of the time callback."
-        return time.time()
+    # Internal: Default implementation of the time callback. Being a plain
+    # function, this avoids a Python-level method call on every reading.
+    _time = staticmethod(getattr(time, 'monotonic', time.time))
     def _sleep(self, delay):
         "Internal: Default implementation of the sleep callback."
         with self:
@@ -135,10 +175,12 @@ class EventScheduler(object):
         (before it starts). See the class docstring for time unit details.
         """
         with self:
-            evt = self.Event(timestamp, self._seq, callback)
-            self._seq += 1
-            heapq.heappush(self.pending, evt)
-            self.cond.notifyAll()
+            seq = next(self._seq)
+            evt = self.Event(timestamp, seq, callback)
+            # The (unique) leading (time, seq) pair decides all comparisons,
+            # so heapq never has to call back into Event's methods.
+            heapq.heappush(self.pending, (timestamp, seq, evt))
+            self.cond.notify()
             return evt
     def add(self, delay, callback):
         """
@@ -168,7 +210,7 @@ class EventScheduler(object):
         with self:
             event.canceled = True
             ret = (not event.handled)
-            self.cond.notifyAll()
+            self.cond.notify()
             return ret
     def clear(self):
         """
@@ -179,7 +221,7 @@ class EventScheduler(object):
         """
         with self:
             self.pending[:] = []
-            self.cond.notifyAll()
+            self.cond.notify()
     def set_forever(self, v):
         """
         Set whether this EventScheduler should wait for additional tasks when
@@ -192,7 +234,7 @@ class EventScheduler(object):
         """
         with self:
             self.forever = v
-            self.cond.notifyAll()
+            self.cond.notify()
     def shutdown(self):
         "A convenience alias for set_forever(False)."
         self.set_forever(False)
@@ -202,7 +244,7 @@ class EventScheduler(object):
         """
         with self:
             while self.running:
-                self.cond.wait()
+                self._stopped.wait()
     def on_error(self, exc):
         """
         Error handling callback.
@@ -230,7 +272,7 @@ class EventScheduler(object):
             with self:
                 if not self.pending: break
                 now = self.time()
-                head = self.pending[0]
+                head = self.pending[0][2]
                 if head.time > now and not head.canceled:
                     wait = head.time - now
                     break
@@ -259,7 +301,7 @@ class EventScheduler(object):
         finally:
             with self:
                 self.running = False
-                self.cond.notifyAll()
+                self._stopped.notifyAll()
 
 class AtomicSequence(object):
     """
@@ -276,13 +318,12 @@ class AtomicSequence(object):
     """
     def __init__(self):
         "Instance initializer; see the class docstring for details."
-        self.value = -1
-        self._lock = threading.Lock()
+        # Advancing an itertools.count is a single C-level operation, which
+        # the GIL makes atomic; no explicit lock is needed.
+        self._counter = itertools.count()
     def __call__(self):
         "Calling protocol support; see the class docstring for details."
-        with self._lock:
-            self.value += 1
-            return self.value
+        return next(self._counter)
 
 class InstantClient(object):
     """
@@ -317,6 +358,16 @@ class InstantClient(object):
     """
     TIMEOUT = None
     COOKIES = None
+    # Maps the "type" field of API messages to the names of the methods
+    # on_message() dispatches them to. The methods are looked up by name on
+    # every message so that overrides (even per-instance ones) take effect.
+    _HANDLERS = {
+        'identity': 'handle_identity', 'pong': 'handle_pong',
+        'joined': 'handle_joined', 'who': 'handle_who',
+        'unicast': 'handle_unicast', 'broadcast': 'handle_broadcast',
+        'response': 'handle_response', 'left': 'handle_left',
+        'error': 'handle_error'
+    }
     def __init__(self, url, **kwds):
         "Instance initializer; see the class docstring for details."
         self.url = url
@@ -368,16 +419,9 @@ class InstantClient(object):
         other handle_*() methods do nothing as default (unless, of course,
         they are overridden).
         """
-        content = json.loads(rawmsg)
+        content = _decode_json(rawmsg)
         msgt = content.get('type')
-        func = {
-            'identity': self.handle_identity, 'pong': self.handle_pong,
-            'joined': self.handle_joined, 'who': self.handle_who,
-            'unicast': self.handle_unicast,
-            'broadcast': self.handle_broadcast,
-            'response': self.handle_response, 'left': self.handle_left,
-            'error': self.handle_error
-        }.get(msgt, self.on_unknown)
+        func = getattr(self, self._HANDLERS.get(msgt, 'on_unknown'))
         func(content, rawmsg)
     def on_frame(self, msgtype, content, final):
         """
@@ -567,7 +611,7 @@ class InstantClient(object):
         """
         seq = self.sequence()
         content['seq'] = seq
-        self.send_raw(json.dumps(content, separators=(',', ':')), **kwds)
+        self.send_raw(_encode_json(content), **kwds)
         return seq
     def send_unicast(self, dest, data, **kwds):
         """
@@ -1256,6 +1300,9 @@ def open_file(path, mode, **kwds):
     or output is opened (depending on the first character of mode), which does
     not close the underlying file descriptor when closed; aside from the
     exception above, all arguments are forwarded to the io.open() function.
+    As the new file object has its own buffer, sys.stdout is flushed before
+    wrapping standard output so that output written through either of them
+    stays in order.
     """
     # We use io.open() since it allows using file descriptors in both Py2K
     # and Py3K.
@@ -1264,6 +1311,7 @@ def open_file(path, mode, **kwds):
         if mode[:1] == 'r':
             return io.open(sys.stdin.fileno(), mode, **kwds)
         elif mode[:1] in ('w', 'a'):
+            sys.stdout.flush()
             return io.open(sys.stdout.fileno(), mode, **kwds)
         else:
             raise ValueError('Unrecognized open_file() mode: %r' %
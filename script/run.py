@@ -394,7 +394,7 @@ class BaseProcess:
 
     def init(self):
         def add_child(executor, routine):
-            executor.waits.add(self._child)
+            executor.waits[self._child.pid] = self._child
         if self._child is not None:
             yield coroutines.CallbackSuspend(add_child)
 